@@ -2,15 +2,85 @@
 # Script to read all files in a directory of SPECTRE-compatible device model
 # files, and convert them to a form that is compatible with ngspice.
 
-import glob
+import functools
+import itertools
+import multiprocessing
 import os
-import pprint
 import re
 import sys
 
 def usage():
     print('spectre_to_spice.py <path_to_spectre> <path_to_spice>')
 
+# Parameter line patterns
+RE_PARM1            = re.compile(r'[ \t]*parameters[ \t]*(.*)')
+RE_PARM2            = re.compile(r'[ \t]*params:[ \t]*(.*)')
+RE_PARM3            = re.compile(r'[ \t]*\+[ \t]*(.*)')
+RE_PARM4            = re.compile(r'[ \t]*([^= \t]+)[ \t]*=[ \t]*([^ \t]+)[ \t]*(.*)')
+RE_PARM5            = re.compile(r'[ \t]*([^= \t]+)[ \t]*(.*)')
+
+# Continuation of a parameter value containing spaces.  Tokens after a
+# space are part of the value unless they begin with an alphabetical
+# character (parameter name) or '$' (comment), but any token following an
+# operator is taken.  A token is an operator if it is contained in EXPR_OPS.
+EXPR_OPS            = '+-*/(){}^~!'
+EXPR_OP_TOKENS      = [EXPR_OPS[i:j] for i in range(len(EXPR_OPS)) for j in range(len(EXPR_OPS), i, -1)]
+RE_EXPR_TOKEN       = r'[^ \t\n]+(?![^ \t\n])[ \t]*'
+RE_EXPR_OP          = r'(?:' + '|'.join(map(re.escape, EXPR_OP_TOKENS)) + r')(?![^ \t\n])[ \t]*'
+RE_EXPR             = re.compile(r'(?:(?:' + RE_EXPR_OP + r')+(?:' + RE_EXPR_TOKEN + r')?|'
+                                 r'(?![^\W\d_]|\$)' + RE_EXPR_TOKEN + r')*')
+
+# SPECTRE and CDL syntax patterns.  Those starting with a keyword are
+# matched against the line with leading whitespace removed, so that the
+# regex engine can use the keyword as a literal prefix.
+RE_STATISTICS       = re.compile(r'statistics[ \t]*\{(.*)')
+RE_SIMULATOR        = re.compile(r'simulator[ \t]+([^= \t]+)[ \t]*=[ \t]*(.+)')
+RE_INLINE_SUBCKT    = re.compile(r'inline[ \t]+subckt[ \t]+([^ \t\(]+)[ \t]*\(([^)]*)')
+RE_CDL_SUBCKT       = re.compile(r'\.?subckt[ \t]+([^ \t\(]+)[ \t]*\(([^)]*)')
+RE_ENDS             = re.compile(r'ends[ \t]+(.+)')
+RE_ENDS_ONLY        = re.compile(r'ends[ \t]*')
+RE_MODEL            = re.compile(r'model[ \t]+([^ \t]+)[ \t]+([^ \t]+)[ \t]+\{(.*)')
+RE_CDL_MODEL        = re.compile(r'model[ \t]+([^ \t]+)[ \t]+([^ \t]+)[ \t]+(.*)')
+RE_BIN              = re.compile(r'[ \t]*([0-9]+):[ \t]+type[ \t]*=[ \t]*(.*)')
+
+# Standard SPICE syntax patterns
+RE_STD_SUBCKT       = re.compile(r'\.subckt[ \t]+([^ \t]+)[ \t]+(.*)')
+RE_STD_MODEL        = re.compile(r'\.model[ \t]+([^ \t]+)[ \t]+([^ \t]+)[ \t]+(.*)')
+RE_STD_ENDS         = re.compile(r'\.ends[ \t]+(.+)')
+RE_STD_ENDS_ONLY    = re.compile(r'\.ends[ \t]*')
+
+# Leading keyword of a stripped line, selecting which of the patterns above
+# can match
+RE_KEYWORD          = re.compile(r'(?P<simulator>simulator)|(?P<param>param(?:eters|s:))|'
+                                 r'(?P<statistics>statistics)|(?P<model>\.?model)|(?P<inline>inline)|'
+                                 r'(?P<subckt>\.?subckt)|(?P<ends>\.?ends)')
+
+# Devices (capacitor, resistor, or CDL device as resistor or capacitor).
+# The alternatives are tried in order and the name of the alternative
+# that matched is given by lastgroup.
+RE_DEVICE           = re.compile(r'(?P<cap>c([^ \t]+)[ \t]*\(([^)]*)\)[ \t]*capacitor[ \t]*(.*))|'
+                                 r'(?P<res>r([^ \t]+)[ \t]*\(([^)]*)\)[ \t]*resistor[ \t]*(.*))|'
+                                 r'(?P<cdl>[ \t]*([crdlmqx])([^ \t]+)[ \t]*\(([^)]*)\)[ \t]*([^ \t]+)[ \t]*(.*))',
+                                 re.IGNORECASE)
+
+# SPICE device letter for a subcircuit call, by leading part of the model type
+MODTYPE_PREFIX      = {'bsim': 'M', 'nmos': 'M', 'pmos': 'M', 'res': 'R', 'cap': 'C', 'pnp': 'Q', 'npn': 'Q', 'd': 'D'}
+
+# Characters that can begin a line matched by RE_KEYWORD or RE_DEVICE
+KEYWORD_START       = 'spmie.'
+DEVICE_START        = 'crdlmqx'
+
+# Return the pattern matching a call to the subcircuit "subname".  Files
+# tend to repeat the same subcircuit names, so the compiled patterns are
+# cached.
+
+@functools.lru_cache(maxsize=256)
+def device_regex(subname, isspectre):
+    if isspectre:
+        return re.compile(re.escape(subname) + r'[ \t]*\(([^)]*)\)[ \t]*([^ \t]+)[ \t]*(.*)', re.IGNORECASE)
+    else:
+        return re.compile(re.escape(subname) + r'[ \t]*([^ \t]+)[ \t]*([^ \t]+)[ \t]*(.*)', re.IGNORECASE)
+
 # Check if a parameter value is a valid number (real, float, integer)
 # or is some kind of expression.
 
@@ -29,28 +99,32 @@ def is_number(s):
 # change it to ".param"
 
 def parse_param_line(line, inparam, insub, iscall, ispassed):
+    """
+
+    >>> parse_param_line('parameters vth0 = 0.45 + dvth0 * (1 - mult) tox=4.1e-9', False, False, False, False)
+    ('.param vth0 = {0.45+dvth0*(1-mult)} tox = 4.1e-9', False)
 
-    # Regexp patterns
-    parm1rex = re.compile('[ \t]*parameters[ \t]*(.*)')
-    parm2rex = re.compile('[ \t]*params:[ \t]*(.*)')
-    parm3rex = re.compile('[ \t]*\+[ \t]*(.*)')
-    parm4rex = re.compile('[ \t]*([^= \t]+)[ \t]*=[ \t]*([^ \t]+)[ \t]*(.*)')
-    parm5rex = re.compile('[ \t]*([^= \t]+)[ \t]*(.*)')
-    rtok = re.compile('([^ \t\n]+)[ \t]*(.*)')
+    >>> parse_param_line('+ dl = 1e-8 dev/gauss=1e-9', True, False, False, False)
+    ('+ dl = 1e-8 dev/gauss = 1e-9', False)
+
+    >>> parse_param_line('l=l w=w mult = 1', True, True, True, False)
+    ('l = {l} w = {w} mult = 1', False)
+
+    """
 
     fmtline = []
 
     if iscall:
         rest = line
     elif inparam:
-        pmatch = parm3rex.match(line)
+        pmatch = RE_PARM3.match(line)
         if pmatch:
             fmtline.append('+')
             rest = pmatch.group(1)
         else:
             return '', ispassed
     else:
-        pmatch = parm1rex.match(line)
+        pmatch = RE_PARM1.match(line)
         if pmatch:
             if insub:
                 fmtline.append('+')
@@ -58,7 +132,7 @@ def parse_param_line(line, inparam, insub, iscall, ispassed):
                 fmtline.append('.param')
             rest = pmatch.group(1)
         else:
-            pmatch = parm2rex.match(line)
+            pmatch = RE_PARM2.match(line)
             if pmatch:
                 if insub:
                     fmtline.append('+')
@@ -69,7 +143,7 @@ def parse_param_line(line, inparam, insub, iscall, ispassed):
                 return '', ispassed
 
     while rest != '':
-        pmatch = parm4rex.match(rest)
+        pmatch = RE_PARM4.match(rest)
         if pmatch:
             if ispassed:
                 # End of passed parameters.  Break line and generate ".param"
@@ -85,22 +159,9 @@ def parse_param_line(line, inparam, insub, iscall, ispassed):
             # as indicated by something after a space not being an
             # alphabetical character (parameter name) or '$' (comment)
 
-            needmore = False
-            while rest != '':
-                rmatch = rtok.match(rest)
-                if rmatch:
-                    expch = rmatch.group(1)[0]
-                    if (expch.isalpha() or expch == '$') and not needmore:
-                        break
-                    else:
-                        needmore = False
-                        value += rmatch.group(1)
-                        rest = rmatch.group(2)
-                        expch = rmatch.group(1).strip()
-                        if expch in '+-*/(){}^~!':
-                            needmore = True
-                else:
-                    break
+            ematch = RE_EXPR.match(rest)
+            value += ematch.group(0).replace(' ', '').replace('\t', '')
+            rest = rest[ematch.end():]
 
             if is_number(value):
                 fmtline.append(value)
@@ -113,7 +174,7 @@ def parse_param_line(line, inparam, insub, iscall, ispassed):
             # were already in-line comments.
 
             if rest != '':
-                nmatch = parm4rex.match(rest)
+                nmatch = RE_PARM4.match(rest)
                 if not nmatch:
                     if rest.lstrip().startswith('$ '):
                         fmtline.append(rest)
@@ -125,7 +186,7 @@ def parse_param_line(line, inparam, insub, iscall, ispassed):
             # assumes that the parameter is always passed, and therefore must
             # be part of the .subckt line.  A parameter without a value is not
             # legal SPICE, so supply a default value of 1.
-            pmatch = parm5rex.match(rest)
+            pmatch = RE_PARM5.match(rest)
             if pmatch:
                 fmtline.append(pmatch.group(1) + '=1')
                 ispassed = True
@@ -142,28 +203,6 @@ def convert_file(in_file, out_file, nocmt):
     #    return
     print("Starting to convert", in_file)
 
-    # Regexp patterns
-    statrex = re.compile('[ \t]*statistics[ \t]*\{(.*)')
-    simrex = re.compile('[ \t]*simulator[ \t]+([^= \t]+)[ \t]*=[ \t]*(.+)')
-    insubrex = re.compile('[ \t]*inline[ \t]+subckt[ \t]+([^ \t\(]+)[ \t]*\(([^)]*)')
-    cdlsubrex = re.compile('\.?subckt[ \t]+([^ \t\(]+)[ \t]*\(([^)]*)')
-    endsubrex = re.compile('[ \t]*ends[ \t]+(.+)')
-    endonlysubrex = re.compile('[ \t]*ends[ \t]*')
-    modelrex = re.compile('[ \t]*model[ \t]+([^ \t]+)[ \t]+([^ \t]+)[ \t]+\{(.*)')
-    cdlmodelrex = re.compile('[ \t]*model[ \t]+([^ \t]+)[ \t]+([^ \t]+)[ \t]+(.*)')
-    binrex = re.compile('[ \t]*([0-9]+):[ \t]+type[ \t]*=[ \t]*(.*)')
-    shincrex = re.compile('\.inc[ \t]+')
-
-    stdsubrex = re.compile('\.subckt[ \t]+([^ \t]+)[ \t]+(.*)')
-    stdmodelrex = re.compile('\.model[ \t]+([^ \t]+)[ \t]+([^ \t]+)[ \t]+(.*)')
-    stdendsubrex = re.compile('\.ends[ \t]+(.+)')
-    stdendonlysubrex = re.compile('\.ends[ \t]*')
-
-    # Devices (resistor, capacitor, subcircuit as resistor or capacitor)
-    caprex = re.compile('c([^ \t]+)[ \t]*\(([^)]*)\)[ \t]*capacitor[ \t]*(.*)', re.IGNORECASE)
-    resrex = re.compile('r([^ \t]+)[ \t]*\(([^)]*)\)[ \t]*resistor[ \t]*(.*)', re.IGNORECASE)
-    cdlrex = re.compile('[ \t]*([crdlmqx])([^ \t]+)[ \t]*\(([^)]*)\)[ \t]*([^ \t]+)[ \t]*(.*)', re.IGNORECASE)
-
     in_dir = os.path.dirname(in_file)
 
     with open(in_file, 'r') as ifile:
@@ -180,27 +219,27 @@ def convert_file(in_file, out_file, nocmt):
         else:
             return m.group(0)
 
-    idata = RE_TRAILING_WS.sub('', idata)
+    # Trailing whitespace is removed line by line as the lines are used
     idata = RE_INCLUDE.sub(include, idata)
 
     if nocmt:
-        idata = idata.splitlines()
-        speclines = [idata[0]]
+        lines = idata.splitlines()
+        speclines = lines[:1]
         comments = []
-        for l in idata[1:]:
+        for l in itertools.islice(lines, 1, None):
             if l.strip().startswith('*'):
                 if not l.startswith('*.'):
-                    comments.append(l)
+                    comments.append(l.rstrip(' \t'))
                     continue
             speclines.append(l)
-            if comments[-1] != '...':
+            if comments and comments[-1] != '...':
                 comments.append('...')
 
         if len(comments) > 1:
             cmt_file = out_file+'.comments'
             print("Writing comments to:", cmt_file)
-            assert not os.path.exists(cmt_file), cmt_file
-            with open(cmt_file, 'w') as f:
+            # Mode 'x' fails with FileExistsError if the file already exists
+            with open(cmt_file, 'x') as f:
                 for c in comments:
                     f.write(c)
                     f.write('\n')
@@ -223,69 +262,71 @@ def convert_file(in_file, out_file, nocmt):
     modtype = ''
 
     for line in speclines:
+        line = line.rstrip(' \t')
+
+        # Strip the line once;  the checks below only need the stripped
+        # line and its first character.
+        stripped = line.strip()
+        first = stripped[:1]
 
         # Item 1a.  C++-style // comments get replaced with * comment character
-        if line.strip().startswith('//'):
+        if stripped.startswith('//'):
             # Replace the leading "//" with SPICE-style comment "*".
             if modellines != []:
-                modellines.append(line.strip().replace('//', '*', 1))
+                modellines.append(stripped.replace('//', '*', 1))
             elif calllines != []:
-                calllines.append(line.strip().replace('//', '*', 1))
+                calllines.append(stripped.replace('//', '*', 1))
             else:
-                spicelines.append(line.strip().replace('//', '*', 1))
+                spicelines.append(stripped.replace('//', '*', 1))
             continue
 
         # Item 1b.  In-line C++-style // comments get replaced with $ comment character
+        # (This cannot change the first character of the stripped line.)
         elif ' //' in line:
             line = line.replace(' //', ' $ ', 1)
+            stripped = line.strip()
         elif '//' in line:
             line = line.replace('//', ' $ ', 1)
+            stripped = line.strip()
         elif '\t//' in line:
             line = line.replace('\t//', '\t$ ', 1)
+            stripped = line.strip()
 
         # Item 2.  Handle SPICE-style comment lines
-        if line.strip().startswith('*'):
+        if first == '*':
             if modellines != []:
-                modellines.append(line.strip())
+                modellines.append(stripped)
             elif calllines != []:
-                calllines.append(line.strip())
+                calllines.append(stripped)
             else:
-                spicelines.append(line.strip())
+                spicelines.append(stripped)
             continue
 
         # Item 4.  Flag continuation lines
-        if line.strip().startswith('+'):
+        if first == '+':
             contline = True
         else:
             contline = False
-            if line.strip() != '':
+            if stripped != '':
                 if inparam:
                     inparam = False
                 if inpinlist:
                     inpinlist = False
 
         # Item 3.  Handle blank lines like comment lines
-        if line.strip() == '':
+        if stripped == '':
             if modellines != []:
-                modellines.append(line.strip())
+                modellines.append(stripped)
             elif calllines != []:
-                calllines.append(line.strip())
+                calllines.append(stripped)
             else:
-                spicelines.append(line.strip())
+                spicelines.append(stripped)
             continue
 
         # Item 5.  Count through { ... } blocks that are not SPICE syntax
+        # (The closing line of the block is commented out as well.)
         if blockskip > 0:
-            # Warning:  Assumes one brace per line, may or may not be true
-            if '{' in line:
-                blockskip = blockskip + 1
-            elif '}' in line:
-                blockskip = blockskip - 1
-                if blockskip == 0:
-                    spicelines.append('* ' + line)
-                    continue
-
-        if blockskip > 0:
+            blockskip += line.count('{') - line.count('}')
             spicelines.append('* ' + line)
             continue
 
@@ -305,8 +346,13 @@ def convert_file(in_file, out_file, nocmt):
 
         # Item 7.  Regexp matching
 
+        # The first character of the line rules out most patterns without
+        # needing to run them.
+        kmatch = RE_KEYWORD.match(stripped) if first in KEYWORD_START else None
+        keyword = kmatch.lastgroup if kmatch else None
+
         # Catch "simulator lang="
-        smatch = simrex.match(line)
+        smatch = RE_SIMULATOR.match(stripped) if keyword == 'simulator' else None
         if smatch:
             if smatch.group(1) == 'lang':
                 if smatch.group(2) == 'spice':
@@ -317,30 +363,34 @@ def convert_file(in_file, out_file, nocmt):
 
         # If inside a subcircuit, remove "parameters".  If outside,
         # change it to ".param"
-        fmtline, ispassed = parse_param_line(line, inparam, insub, False, ispassed)
-        if fmtline != '':
-            inparam = True
-            spicelines.append(fmtline)
-            continue
+        if keyword == 'param':
+            fmtline, ispassed = parse_param_line(line, inparam, insub, False, ispassed)
+            if fmtline != '':
+                inparam = True
+                spicelines.append(fmtline)
+                continue
 
         # statistics---not sure if it is always outside an inline subcircuit
-        smatch = statrex.match(line)
+        smatch = RE_STATISTICS.match(stripped) if keyword == 'statistics' else None
         if smatch:
-            if '}' not in smatch.group(1):
-                blockskip = 1
+            depth = 1 + smatch.group(1).count('{') - smatch.group(1).count('}')
+            if depth > 0:
+                blockskip = depth
                 spicelines.append('* ' + line)
                 continue
 
         # model---not sure if it is always inside an inline subcircuit
         iscdl = False
-        if isspectre:
-            mmatch = modelrex.match(line)
+        if keyword != 'model':
+            mmatch = None
+        elif isspectre:
+            mmatch = RE_MODEL.match(stripped)
             if not mmatch:
-                mmatch = cdlmodelrex.match(line)
+                mmatch = RE_CDL_MODEL.match(stripped)
                 if mmatch:
                     iscdl = True
         else:
-            mmatch = stdmodelrex.match(line)
+            mmatch = RE_STD_MODEL.match(line)
 
         if mmatch:
             modname = mmatch.group(1)
@@ -361,16 +411,17 @@ def convert_file(in_file, out_file, nocmt):
 
         if not insub:
             # Things to parse if not in a subcircuit
-            imatch = insubrex.match(line) if isspectre else None
+            imatch = None
+            if keyword == 'inline':
+                imatch = RE_INLINE_SUBCKT.match(stripped) if isspectre else None
 
-            if not imatch:
+            elif keyword == 'subckt':
                 # Check for spectre format subckt or CDL format .subckt lines
-                imatch = cdlsubrex.match(line)
+                imatch = RE_CDL_SUBCKT.match(line)
 
-            if not imatch:
-                if not isspectre:
+                if not imatch and not isspectre:
                     # Check for standard SPICE format .subckt lines
-                    imatch = stdsubrex.match(line)
+                    imatch = RE_STD_SUBCKT.match(line)
 
             if imatch:
                 # If a model block is pending, then dump it
@@ -383,10 +434,7 @@ def convert_file(in_file, out_file, nocmt):
                 insub = True
                 ispassed = True
                 subname = imatch.group(1)
-                if isspectre:
-                    devrex = re.compile(subname + '[ \t]*\(([^)]*)\)[ \t]*([^ \t]+)[ \t]*(.*)', re.IGNORECASE)
-                else:
-                    devrex = re.compile(subname + '[ \t]*([^ \t]+)[ \t]*([^ \t]+)[ \t]*(.*)', re.IGNORECASE)
+                devrex = device_regex(subname, isspectre)
                 # If there is no close-parenthesis then we should expect it on
                 # a continuation line
                 inpinlist = True if ')' not in line else False
@@ -409,14 +457,16 @@ def convert_file(in_file, out_file, nocmt):
                 continue
 
             else:
-                if isspectre:
-                    ematch = endsubrex.match(line)
+                if keyword != 'ends':
+                    ematch = None
+                elif isspectre:
+                    ematch = RE_ENDS.match(stripped)
                     if not ematch:
-                        ematch = endonlysubrex.match(line)
+                        ematch = RE_ENDS_ONLY.match(stripped)
                 else:
-                    ematch = stdendsubrex.match(line)
+                    ematch = RE_STD_ENDS.match(line)
                     if not ematch:
-                        ematch = stdendonlysubrex.match(line)
+                        ematch = RE_STD_ENDS_ONLY.match(line)
 
                 if ematch:
                     esubname = ematch.group(1)
@@ -426,22 +476,10 @@ def convert_file(in_file, out_file, nocmt):
                         print('"subckt" name = ' + subname)
                     if len(calllines) > 0:
                         line = calllines[0]
-                        if modtype.startswith('bsim'):
-                            line = 'M' + line
-                        elif modtype.startswith('nmos'):
-                            line = 'M' + line
-                        elif modtype.startswith('pmos'):
-                            line = 'M' + line
-                        elif modtype.startswith('res'):
-                            line = 'R' + line
-                        elif modtype.startswith('cap'):
-                            line = 'C' + line
-                        elif modtype.startswith('pnp'):
-                            line = 'Q' + line
-                        elif modtype.startswith('npn'):
-                            line = 'Q' + line
-                        elif modtype.startswith('d'):
-                            line = 'D' + line
+                        for n in (4, 3, 1):
+                            if modtype[:n] in MODTYPE_PREFIX:
+                                line = MODTYPE_PREFIX[modtype[:n]] + line
+                                break
                         spicelines.append(line)
 
                         # Will need more handling here for other component types. . .
@@ -470,34 +508,30 @@ def convert_file(in_file, out_file, nocmt):
                     inmodel = False
                     continue
 
-            # Check for devices R and C.
-            dmatch = caprex.match(line)
-            if dmatch:
-                fmtline, ispassed = parse_param_line(dmatch.group(3), True, insub, True, ispassed)
-                if fmtline != '':
-                    inparam = True
-                    spicelines.append('c' + dmatch.group(1) + ' ' + dmatch.group(2) + ' ' + fmtline)
-                    continue
-                else:
-                    spicelines.append('c' + dmatch.group(1) + ' ' + dmatch.group(2) + ' ' + dmatch.group(3))
-                    continue
+            # Check for devices R and C, and CDL devices.
+            dmatch = None
+            if first.lower() in DEVICE_START:
+                dmatch = RE_DEVICE.match(line)
 
-            dmatch = resrex.match(line)
-            if dmatch:
-                fmtline, ispassed = parse_param_line(dmatch.group(3), True, insub, True, ispassed)
+            if dmatch and dmatch.lastgroup != 'cdl':
+                # Capacitor or resistor
+                devtype = dmatch.lastgroup[0]
+                i = dmatch.re.groupindex[dmatch.lastgroup]
+                devname, devpins, devparams = dmatch.group(i + 1, i + 2, i + 3)
+
+                fmtline, ispassed = parse_param_line(devparams, True, insub, True, ispassed)
                 if fmtline != '':
                     inparam = True
-                    spicelines.append('r' + dmatch.group(1) + ' ' + dmatch.group(2) + ' ' + fmtline)
+                    spicelines.append(devtype + devname + ' ' + devpins + ' ' + fmtline)
                     continue
                 else:
-                    spicelines.append('r' + dmatch.group(1) + ' ' + dmatch.group(2) + ' ' + dmatch.group(3))
+                    spicelines.append(devtype + devname + ' ' + devpins + ' ' + devparams)
                     continue
 
-            cmatch = cdlrex.match(line)
-            if cmatch:
+            if dmatch:
                 ispassed = False
-                devtype = cmatch.group(1)
-                devmodel = cmatch.group(4)
+                i = dmatch.re.groupindex['cdl']
+                devtype, devname, devpins, devmodel, devparams = dmatch.group(i + 1, i + 2, i + 3, i + 4, i + 5)
 
                 # Handle spectreisms. . .
                 if devmodel == 'capacitor':
@@ -513,13 +547,13 @@ def convert_file(in_file, out_file, nocmt):
                     # model is a resistor and not a subcircuit.
                     devtype = 'r'
 
-                fmtline, ispassed = parse_param_line(cmatch.group(5), True, insub, True, ispassed)
+                fmtline, ispassed = parse_param_line(devparams, True, insub, True, ispassed)
                 if fmtline != '':
                     inparam = True
-                    spicelines.append(devtype + cmatch.group(2) + ' ' + cmatch.group(3) + ' ' + devmodel + ' ' + fmtline)
+                    spicelines.append(devtype + devname + ' ' + devpins + ' ' + devmodel + ' ' + fmtline)
                     continue
                 else:
-                    spicelines.append(devtype + cmatch.group(2) + ' ' + cmatch.group(3) + ' ' + devmodel + ' ' + cmatch.group(5))
+                    spicelines.append(devtype + devname + ' ' + devpins + ' ' + devmodel + ' ' + devparams)
                     continue
 
             # Check for a line that begins with the subcircuit name
@@ -538,10 +572,10 @@ def convert_file(in_file, out_file, nocmt):
         if inmodel == 1 or inmodel == 2:
             # This line should have the model bin, if there is one, and a type.
             if inmodel == 1:
-                bmatch = binrex.match(savematch.group(3))
+                bmatch = RE_BIN.match(savematch.group(3))
                 savematch = None
             else:
-                bmatch = binrex.match(line)
+                bmatch = RE_BIN.match(line)
 
             if bmatch:
                 bin = bmatch.group(1)
@@ -557,7 +591,7 @@ def convert_file(in_file, out_file, nocmt):
                 # If there is a binned model then it replaces any original
                 # model line that was saved.
                 if modellines[-1].startswith('.model'):
-                    modellines = modellines[0:-1]
+                    modellines.pop()
                 modellines.append('')
                 modellines.append('.model ' + modname + '.' + bin + ' ' + convtype)
                 continue
@@ -571,16 +605,14 @@ def convert_file(in_file, out_file, nocmt):
         # Copy line as-is
         spicelines.append(line)
 
-    output = '\n'.join(spicelines)
-    output = cleanup_spice_data(output)
+    output = join_spice_lines(cleanup_spice_lines(spicelines))
     if not output.strip():
         print("Skipping empty file:", outfile)
         return
 
     # Output the result to out_file.
     print("Writing", out_file)
-    assert not os.path.exists(out_file), out_file
-    with open(out_file, 'w') as ofile:
+    with open(out_file, 'x') as ofile:
         ofile.write(output)
 
 
@@ -619,21 +651,71 @@ RE_CMT_FULL_LINE    = re.compile('\\n(\\*[^\\.]*[^\\n]*\\n)+')
 # XXXX $ <comment>
 RE_CMT_END_LINE     = re.compile('\\$.*?$', flags=re.MULTILINE)
 
-RE_LINE_PLUS_START  = re.compile('^\\+([ \\t]*)', flags=re.MULTILINE)
 RE_LINE_EQUALS      = re.compile('[ \\t]+=[ \\t]+')
-RE_CMT_INCLUDE_IG   = re.compile('^\\*\\*Include files in.*\\n', flags=re.MULTILINE)
-RE_EXTRA_CMT        = re.compile('^(\\*\\*\\*\\n)+', flags=re.MULTILINE)
 RE_BIG_CMT          = re.compile('^\\*\\*\\*(.*)$', flags=re.MULTILINE)
 RE_SMALL_CMT        = re.compile('\\n(\\*[ \\t]*\\n)+', flags=re.MULTILINE)
-RE_MULTI_NEWLINE    = re.compile('\\n+')
-RE_INCLUDE          = re.compile('^\\.inc(lude)?[ \\t]+"(?P<file>[^"]+)"$', flags=re.MULTILINE|re.IGNORECASE)
+RE_INCLUDE          = re.compile('^\\.inc(lude)?[ \\t]+"(?P<file>[^"]+)"[ \\t]*$', flags=re.MULTILINE|re.IGNORECASE)
 RE_INCLUDE_CMT      = re.compile('^\\*[ \\t]*\\.inc(lude)?[ \\t]+"(?P<file>[^"]+)"$', flags=re.MULTILINE|re.IGNORECASE)
-RE_TRAILING_WS      = re.compile('[ \\t]+$', flags=re.MULTILINE)
 
 def cleanup_comment(m):
     return '*** ' + ' '.join(m.group(1).strip().split())
 
 
+# Clean up the converted SPICE output in a single pass over its lines,
+# yielding the lines to keep.  Entries of "lines" may themselves contain
+# newlines.  The "**Include files in" and bare "***" lines are removed
+# everywhere but on the last line, and blank lines are dropped.
+
+def cleanup_spice_lines(lines):
+    prev = None
+    for text in lines:
+        for line in text.split('\n'):
+            if prev is not None:
+                prev = cleanup_spice_line(prev, False)
+                if prev:
+                    yield prev
+            prev = line
+
+    if prev is not None:
+        prev = cleanup_spice_line(prev, True)
+        if prev:
+            yield prev
+
+
+# Clean up one line of output.  Return the empty string if the line is to
+# be removed.
+
+def cleanup_spice_line(line, last):
+    line = line.rstrip(' \t')
+    if line.startswith('+'):
+        line = '+ ' + line[1:].lstrip(' \t')
+    if '=' in line:
+        line = RE_LINE_EQUALS.sub(' = ', line)
+
+    if line.startswith('*'):
+        if not last and (line == '***' or line.startswith('**Include files in')):
+            return ''
+        if line.startswith('***'):
+            line = RE_BIG_CMT.sub(cleanup_comment, line)
+        else:
+            line = RE_INCLUDE_CMT.sub('*.include "\\g<file>"', line)
+    elif line.startswith('.'):
+        line = RE_INCLUDE.sub('.include "\\g<file>"', line)
+
+    assert '.inc ' not in line, line
+    return line
+
+
+# Join the cleaned up lines into the final output text
+
+def join_spice_lines(lines):
+    data = '\n'.join(lines).strip()
+    if data[-1] != '\n':
+        data += '\n'
+
+    return data
+
+
 def cleanup_spice_data(data):
     """
 
@@ -666,34 +748,17 @@ def cleanup_spice_data(data):
 
     # "../../s8x/Models/ss.cor"
 
-    data = RE_TRAILING_WS.sub('', data)
-
-    data = RE_LINE_PLUS_START.sub('+ ', data)
-    data = RE_LINE_EQUALS.sub(' = ', data)
-    data = RE_CMT_INCLUDE_IG.sub('', data)
-    data = RE_EXTRA_CMT.sub('', data)
-    data = RE_BIG_CMT.sub(cleanup_comment, data)
-    data = RE_MULTI_NEWLINE.sub('\n', data)
-    data = RE_INCLUDE.sub('.include "\\g<file>"', data)
-    data = RE_INCLUDE_CMT.sub('*.include "\\g<file>"', data)
+    return join_spice_lines(cleanup_spice_lines([data]))
 
 
-    iinc = data.find('.inc ')
-    assert iinc == -1, (iinc, data[iinc-100:iinc+100])
+# Files in a model directory that are not to be converted:  readme files,
+# temporary files, comments written by -nocmt, verilog or verilog-A files,
+# and .scs files, which are purely spectre and meaningless to SPICE.
 
-    data = data.strip()
-    if data[-1] != '\n':
-        data += '\n'
-
-    return data
+SKIP_SUFFIXES = ('readme', '.tmp', '.comments', '.v', '.va', '.scs')
 
 
 if __name__ == '__main__':
-    import doctest
-    fails, _ = doctest.testmod()
-    if fails != 0:
-        sys.exit("Some test failed")
-
     debug = False
 
     if len(sys.argv) == 1:
@@ -710,6 +775,16 @@ if __name__ == '__main__':
         else:
             arguments.append(option)
 
+    # The doctests are only run on request, so that batch conversions do
+    # not pay for them on every invocation.
+    if '-selftest' in optionlist or os.environ.get('SPECTRE2SPICE_SELFTEST'):
+        import doctest
+        fails, _ = doctest.testmod()
+        if fails != 0:
+            sys.exit("Some test failed")
+        if len(arguments) == 0:
+            sys.exit(0)
+
     if len(arguments) != 2:
         print("Wrong number of arguments given to convert_spectre.py.")
         usage()
@@ -752,28 +827,15 @@ if __name__ == '__main__':
         if not os.path.exists(spicepath):
             os.makedirs(spicepath)
 
-        specfilelist = glob.glob(specpath + '/*')
-
-        for filename in specfilelist:
-            if filename.endswith('readme'):
-                continue
-            if filename.endswith('.tmp'):
-                continue
-            if filename.endswith('.comments'):
-                continue
-            fileext = os.path.splitext(filename)[1]
-
-            # Ignore verilog or verilog-A files that might be in a model directory
-            if fileext == '.v' or fileext == '.va':
-                continue
-
-            # .scs files are purely spectre and meaningless to SPICE, so ignore them.
-            if fileext == '.scs':
-                continue
+        # Hidden files are skipped, as they were when listing with glob.
+        with os.scandir(specpath) as entries:
+            specfilelist = [e.path for e in entries if e.is_file() and not e.name.startswith('.')
+                    and not e.name.endswith(SKIP_SUFFIXES)]
 
-            froot = os.path.split(filename)[1]
-            print()
-            convert_file(filename, spicepath + '/' + froot, nocmt)
-            print()
+        # Files are converted independently of each other, so convert them
+        # in parallel.  Messages from different files may be interleaved.
+        with multiprocessing.Pool() as pool:
+            pool.starmap(convert_file, [(filename, spicepath + '/' + os.path.split(filename)[1], nocmt)
+                    for filename in specfilelist])
 
     exit(0)